@@ -3,8 +3,17 @@ import time
 import logging
 import argparse
 import csv
-from datetime import datetime
+import io
+import struct
 from bleak import BleakClient, BleakScanner
+from bleak.exc import BleakError
+
+try:
+  import uvloop  # Optional faster event loop (Linux/macOS)
+except ImportError:
+  uvloop = None
+
+log = logging.getLogger("zone_logger")
 
 # --- UPDATED UUIDS ---
 IFIT_SERVICE_UUID = '00001533-1412-efde-1523-785feabcd123'
@@ -16,6 +25,13 @@ POLAR_HR_UUID = '00002a37-0000-1000-8000-00805f9b34fb'
 POLAR_BATT_UUID = '00002a19-0000-1000-8000-00805f9b34fb'
 POLAR_HR_SERVICE_UUID = "0000180d-0000-1000-8000-00805f9b34fb"
 
+# Lowercased service UUIDs for matching scan advertisements
+_IFIT_UUID_LC = IFIT_SERVICE_UUID.lower()
+_POLAR_UUID_LC = POLAR_HR_SERVICE_UUID.lower()
+
+# Maximum time to scan for devices (seconds)
+SCAN_TIMEOUT = 5.0
+
 # --- HEX COMMANDS ---
 IFIT_INIT_SEQUENCE = [
     bytes.fromhex("fe022c04"),
@@ -30,6 +46,33 @@ IFIT_POLL_SEQUENCE = [
     bytes.fromhex("ff02182700000000000000000000000000000000")
 ]
 
+# Marks the speed/incline/distance record inside iFit notifications
+_IFIT_SIG = b"\x2e\x04\x2e\x02"
+# Record layout after the signature: speed, incline, 2 unused bytes, distance (little-endian u16)
+_IFIT_STRUCT = struct.Struct('<HH2xH')
+
+# Heart Rate Measurement: flags byte followed by the value's low and high bytes
+_HR_STRUCT = struct.Struct('<BBB')
+
+# --- POLLING ---
+POLL_INTERVAL = 1.0
+# Reset the tick schedule when it falls further behind than this (seconds)
+MAX_TICK_LAG = 2.0
+
+# --- CSV LOGGING ---
+CSV_BUFFER_SIZE = 64 * 1024
+CSV_FLUSH_ROWS = 60
+
+async def _acquire_mtu(client, name):
+  # The OS negotiates the ATT MTU on connect; BlueZ needs an explicit acquire to report it
+  backend = getattr(client, '_backend', None)
+  if hasattr(backend, '_acquire_mtu'):
+    try:
+      await backend._acquire_mtu()
+    except Exception as e:
+      log.debug("%s MTU acquire failed: %s", name, e)
+  log.info("%s MTU: %s", name, client.mtu_size)
+
 class IFitDevice:
   def __init__(self, address):
     self.address = address
@@ -38,25 +81,49 @@ class IFitDevice:
     self.incline = 0.0
     self.distance = 0.0
     self.connected = False
+    self._write_response = False
 
   async def connect(self):
-    logging.info(f"Connecting to iFit at {self.address}...")
+    log.info("Connecting to iFit at %s...", self.address)
     self.client = BleakClient(self.address)
-    await self.client.connect()
+    try:
+      await self.client.connect()
+    except BleakError as e:
+      # Concurrent connects on BlueZ can fail with InProgress, retry once
+      log.warning("iFit connect failed (%s), retrying...", e)
+      await asyncio.sleep(1.0)
+      await self.client.connect()
     self.connected = self.client.is_connected
-    logging.info(f"Connected to iFit: {self.connected}")
+    log.info("Connected to iFit: %s", self.connected)
+    if self.connected:
+      await _acquire_mtu(self.client, "iFit")
+      # Use write-without-response only when the command characteristic advertises it,
+      # some backends (CoreBluetooth) silently drop unsupported writes instead of raising
+      char = self.client.services.get_characteristic(IFIT_COMMAND_CHAR_UUID)
+      self._write_response = not (char and "write-without-response" in char.properties)
+      if self._write_response:
+        log.info("iFit does not support write-without-response, using acknowledged writes")
 
   async def setup(self):
     if not self.connected:
       return
 
-    # Start Notifications
-    await self.client.start_notify(IFIT_NOTIFY_CHAR_UUID, self._notification_handler)
+    try:
+      # Start Notifications
+      await self.client.start_notify(IFIT_NOTIFY_CHAR_UUID, self._notification_handler)
 
-    # Initialization Handshake
-    logging.info("Initializing iFit session...")
-    for packet in IFIT_INIT_SEQUENCE:
-      await self.client.write_gatt_char(IFIT_COMMAND_CHAR_UUID, packet, response=True)
+      # Initialization Handshake
+      # Only the last packet waits for an ack, acting as a barrier for the whole handshake
+      log.info("Initializing iFit session...")
+      await self._write_sequence(IFIT_INIT_SEQUENCE, ack_last=True)
+    except Exception as e:
+      log.error("iFit setup error: %s", e)
+      try:
+        await self.close()
+      except Exception:
+        pass
+      self.connected = False
+      return
 
     await asyncio.sleep(2)
 
@@ -64,10 +131,18 @@ class IFitDevice:
     if not self.connected:
       return
     try:
-      for packet in IFIT_POLL_SEQUENCE:
-        await self.client.write_gatt_char(IFIT_COMMAND_CHAR_UUID, packet, response=True)
+      await self._write_sequence(IFIT_POLL_SEQUENCE)
     except Exception as e:
-      logging.error(f"iFit update error: {e}")
+      log.error("iFit update error: %s", e)
+
+  async def _write_sequence(self, sequence, ack_last=False):
+    # The frames form one multi-packet command and must go out in order. Without a
+    # response the write doesn't wait for an ATT round-trip; the next notification
+    # confirms the command.
+    last = len(sequence) - 1
+    for i, packet in enumerate(sequence):
+      response = self._write_response or (ack_last and i == last)
+      await self.client.write_gatt_char(IFIT_COMMAND_CHAR_UUID, packet, response=response)
 
   async def close(self):
     if self.client and self.connected:
@@ -78,22 +153,17 @@ class IFitDevice:
       await self.client.disconnect()
 
   def _notification_handler(self, sender, data: bytearray):
-    logging.debug(f'ifit raw data {data.hex()}')
-    signature = bytes.fromhex("2e042e02")
-    idx = data.find(signature)
+    if log.isEnabledFor(logging.DEBUG):
+      log.debug("ifit raw data %s", data.hex())
+    idx = data.find(_IFIT_SIG)
 
     if idx != -1:
       try:
-        start = idx + 5
-        speed_raw = int.from_bytes(data[start : start + 2], byteorder='little')
+        speed_raw, incline_raw, distance_raw = _IFIT_STRUCT.unpack_from(data, idx + 5)
         self.speed = speed_raw / 100.0
-
-        incline_raw = int.from_bytes(data[start + 2 : start + 4], byteorder='little')
         self.incline = incline_raw / 100.0
-
-        distance_raw = int.from_bytes(data[start + 6 : start + 8], byteorder='little')
         self.distance = distance_raw / 1000.0
-      except (IndexError, ValueError):
+      except struct.error:
         pass
 
 class PolarDevice:
@@ -104,12 +174,13 @@ class PolarDevice:
     self.battery = 0
     self.connected = False
     self._last_battery_read = 0
+    self._battery_task = None
     self._connection_start = 0
 
   async def connect(self):
     if not self.address:
       return
-    logging.info(f"Connecting to Polar at {self.address}...")
+    log.info("Connecting to Polar at %s...", self.address)
     try:
       self.client = BleakClient(self.address, disconnected_callback=self._on_disconnect, timeout=20.0)
       await self.client.connect()
@@ -117,13 +188,15 @@ class PolarDevice:
       self.connected = self.client.is_connected
       if self.connected:
         self._connection_start = time.time()
-      logging.info(f"Connected to Polar: {self.connected}")
+      log.info("Connected to Polar: %s", self.connected)
+      if self.connected:
+        await _acquire_mtu(self.client, "Polar")
     except Exception as e:
-      logging.error(f"Could not connect to Polar: {e}")
+      log.error("Could not connect to Polar: %s", e)
       self.connected = False
 
   def _on_disconnect(self, client):
-    logging.warning("Polar disconnected, make sure is PAIRED at OS level!!!")
+    log.warning("Polar disconnected, make sure is PAIRED at OS level!!!")
     self.connected = False
 
   async def setup(self):
@@ -132,9 +205,9 @@ class PolarDevice:
 
     try:
       await self.client.start_notify(POLAR_HR_UUID, self._hr_handler)
-      logging.info("Polar HR notifications started")
+      log.info("Polar HR notifications started")
     except Exception as e:
-      logging.error(f"Polar setup error: {e}")
+      log.error("Polar setup error: %s", e)
       self.connected = False
 
   async def update(self):
@@ -148,18 +221,33 @@ class PolarDevice:
         await self.setup()
       return
 
+    # Read the battery in the background so the poll tick never waits on the GATT read
     if time.time() - self._last_battery_read > 60:
-      try:
-        await self._read_battery()
-      except Exception as e:
-        logging.error(f"Polar keep-alive error: {e}")
+      if not self._battery_task or self._battery_task.done():
+        self._battery_task = asyncio.create_task(self._read_battery())
+
+  async def read_battery(self):
+    # Wait for a battery read already running in the background, otherwise read it now
+    if self._battery_task and not self._battery_task.done():
+      await self._battery_task
+    elif self.connected:
+      await self._read_battery()
 
   async def _read_battery(self):
-    batt = await self.client.read_gatt_char(POLAR_BATT_UUID)
-    self.battery = int(batt[0])
-    self._last_battery_read = time.time()
+    try:
+      batt = await self.client.read_gatt_char(POLAR_BATT_UUID)
+      self.battery = int(batt[0])
+      self._last_battery_read = time.time()
+    except Exception as e:
+      log.error("Polar keep-alive error: %s", e)
 
   async def close(self):
+    if self._battery_task and not self._battery_task.done():
+      self._battery_task.cancel()
+      try:
+        await self._battery_task
+      except asyncio.CancelledError:
+        pass
     if self.client and self.connected:
       try:
         await self.client.stop_notify(POLAR_HR_UUID)
@@ -168,14 +256,18 @@ class PolarDevice:
         pass
 
   def _hr_handler(self, sender, data: bytearray):
-    logging.debug(f'polar raw data {data.hex()}')
+    if log.isEnabledFor(logging.DEBUG):
+      log.debug("polar raw data %s", data.hex())
     try:
       if not data:
         return
-      flags = data[0]
-      hr_fmt = flags & 0x01
-      hr_val = data[1] if hr_fmt == 0 else int.from_bytes(data[1:3], byteorder='little')
-      self.hr = hr_val
+      if len(data) < 3:
+        # Too short for a 16-bit value, must be a bare 8-bit reading
+        self.hr = data[1]
+        return
+      flags, lo, hi = _HR_STRUCT.unpack_from(data, 0)
+      # Bit 0 of flags selects the 16-bit format; the mask keeps the high byte only then
+      self.hr = lo | ((hi & -(flags & 0x01)) << 8)
     except Exception:
       pass
 
@@ -186,80 +278,136 @@ async def main():
 
   log_level = logging.DEBUG if args.debug else logging.INFO
   logging.basicConfig(level=log_level, format='%(asctime)s - %(levelname)s - %(message)s')
-  logging.info("Scanning for devices...")
+  log.info("Scanning for devices...")
   ifit, ifit_address = None, None
   polar, polar_address = None, None
 
-  devices = await BleakScanner.discover(return_adv=True)
-  for d, adv in devices.values():
-    if not ifit_address and IFIT_SERVICE_UUID.lower() in [u.lower() for u in adv.service_uuids]:
-      print(f"Found iFit: {d.name} [{d.address}]")
+  found_event = asyncio.Event()
+
+  def on_detection(d, adv):
+    nonlocal ifit_address, polar_address
+    uuids = {u.lower() for u in adv.service_uuids}
+    if not ifit_address and _IFIT_UUID_LC in uuids:
+      log.info("Found iFit: %s [%s]", d.name, d.address)
       ifit_address = d.address
 
     if not polar_address:
-      if (POLAR_HR_SERVICE_UUID in [u.lower() for u in adv.service_uuids]) or (d.name and "Polar" in d.name):
-        logging.info(f"Found Polar: {d.name} [{d.address}]")
+      if (_POLAR_UUID_LC in uuids) or (d.name and "Polar" in d.name):
+        log.info("Found Polar: %s [%s]", d.name, d.address)
         polar_address = d.address
 
+    if ifit_address and polar_address:
+      found_event.set()
+
+  # Stop scanning as soon as both devices are seen instead of waiting out the full window
+  scanner = BleakScanner(detection_callback=on_detection)
+  await scanner.start()
+  try:
+    await asyncio.wait_for(found_event.wait(), timeout=SCAN_TIMEOUT)
+  except asyncio.TimeoutError:
+    pass
+  finally:
+    await scanner.stop()
 
   if ifit_address:
     ifit = IFitDevice(ifit_address)
-    await ifit.connect()
   else:
-    logging.warning("iFit device not found. Ensure the treadmill is on.")
+    log.warning("iFit device not found. Ensure the treadmill is on.")
 
   if polar_address:
     polar = PolarDevice(polar_address)
-    await polar.connect()
   else:
-    logging.warning("Polar device not found. Ensure the HR monitor is on.")
+    log.warning("Polar device not found. Ensure the HR monitor is on.")
+
+  # Connect and set up both devices concurrently, a failure on one side doesn't block the other
+  found = [(name, dev) for name, dev in (("iFit", ifit), ("Polar", polar)) if dev]
+  results = await asyncio.gather(*(dev.connect() for _, dev in found), return_exceptions=True)
+  for (name, _), result in zip(found, results):
+    if isinstance(result, Exception):
+      log.error("%s connect error: %s", name, result)
 
   try:
-    if ifit:
-      await ifit.setup()
+    results = await asyncio.gather(*(dev.setup() for _, dev in found), return_exceptions=True)
+    for (name, _), result in zip(found, results):
+      if isinstance(result, Exception):
+        log.error("%s setup error: %s", name, result)
+
+    # Without a working iFit session there is no reconnect path, log without it
+    # rather than writing made-up zero readings
+    if ifit and not ifit.connected:
+      log.warning("iFit not available, logging without treadmill data.")
+      ifit = None
+
     if polar:
-      await polar.setup()
-      # Read battery once at the beginning
+      # Read battery once at the beginning, update() also reconnects if setup dropped the link
       await polar.update()
-      logging.info(f"Polar Battery: {polar.battery}%")
+      await polar.read_battery()
+      log.info("Polar Battery: %s%%", polar.battery)
 
     await asyncio.sleep(3)
 
     # CSV Logging Setup
-    filename = datetime.now().strftime("%Y%m%d-%H%M") + ".csv"
-    logging.info(f"Logging data to {filename}")
+    filename = time.strftime("%Y%m%d-%H%M") + ".csv"
+    log.info("Logging data to %s", filename)
 
-    with open(filename, 'w', newline='', encoding='utf-8') as csvfile:
+    raw_file = open(filename, 'wb', buffering=CSV_BUFFER_SIZE)
+    with io.TextIOWrapper(raw_file, encoding='utf-8', newline='', write_through=False) as csvfile:
       csv_writer = csv.writer(csvfile)
       header = ['timestamp', 'speed_kmh', 'incline_percent', 'distance_km', 'hr_bpm']
       csv_writer.writerow(header)
-
-      logging.info("Starting data poll (Ctrl+C to quit)...")
-      while True:
-        log_items = []
-        if ifit:
-          await ifit.update()
-          log_items.append(f"Speed: {ifit.speed:.2f} km/h")
-          log_items.append(f"Incline: {ifit.incline:.1f}%")
-          log_items.append(f"Dist: {ifit.distance:.3f} km")
-        if polar:
-          await polar.update()
-          log_items.append(f"HR: {polar.hr} bpm")
-        logging.info(", ".join(log_items))
-
-        # Write to CSV
-        csv_writer.writerow([
-          datetime.now().strftime('%Y-%m-%dT%H:%M:%S'),
-          ifit.speed if ifit else None,
-          ifit.incline if ifit else None,
-          ifit.distance if ifit else None,
-          polar.hr if polar else None
-        ])
-
-        await asyncio.sleep(1)
+      writerows = csv_writer.writerows
+      strftime = time.strftime
+      pending_rows = []
+
+      log.info("Starting data poll (Ctrl+C to quit)...")
+      loop = asyncio.get_running_loop()
+      next_tick = loop.time()
+      _info_on = log.isEnabledFor(logging.INFO)
+      try:
+        while True:
+          # Poll both devices concurrently, they are independent BLE connections
+          results = await asyncio.gather(
+            ifit.update() if ifit else asyncio.sleep(0),
+            polar.update() if polar else asyncio.sleep(0),
+            return_exceptions=True
+          )
+          for name, result in zip(("iFit", "Polar"), results):
+            if isinstance(result, Exception):
+              log.error("%s update error: %s", name, result)
+
+          # Snapshot once so the log line and CSV row come from the same sample
+          speed, incline, distance = (ifit.speed, ifit.incline, ifit.distance) if ifit else (None, None, None)
+          hr = polar.hr if polar else None
+
+          if _info_on:
+            log_items = []
+            if ifit:
+              log_items.append(f"Speed: {speed:.2f} km/h")
+              log_items.append(f"Incline: {incline:.1f}%")
+              log_items.append(f"Dist: {distance:.3f} km")
+            if polar:
+              log_items.append(f"HR: {hr} bpm")
+            log.info(", ".join(log_items))
+
+          # Queue the CSV row, writing and flushing in batches of CSV_FLUSH_ROWS rows
+          pending_rows.append((strftime('%Y-%m-%dT%H:%M:%S'), speed, incline, distance, hr))
+          if len(pending_rows) >= CSV_FLUSH_ROWS:
+            writerows(pending_rows)
+            pending_rows.clear()
+            csvfile.flush()
+
+          # Sleep until the next deadline so BLE latency doesn't drift the sample rate
+          next_tick += POLL_INTERVAL
+          if loop.time() - next_tick > MAX_TICK_LAG:
+            log.warning("Poll loop fell behind, resetting tick schedule")
+            next_tick = loop.time() + POLL_INTERVAL
+          await asyncio.sleep(max(0.0, next_tick - loop.time()))
+      finally:
+        # Write whatever is still queued before the file is closed
+        writerows(pending_rows)
 
   except KeyboardInterrupt:
-    logging.info("Stopping...")
+    log.info("Stopping...")
   finally:
     if ifit:
       await ifit.close()
@@ -267,4 +415,7 @@ async def main():
       await polar.close()
 
 if __name__ == "__main__":
-  asyncio.run(main())
+  if uvloop:
+    uvloop.run(main())
+  else:
+    asyncio.run(main())